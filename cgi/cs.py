@@ -11,6 +11,12 @@ CGI script for Simple-Cone-Search-Creator project
 This script enables a Cone Search service
 from a data structure previously created using
 the ingestion script ingest.py
+
+Several catalogues can be served by the same script: they are
+declared in cgi-config.json and selected with the CAT parameter.
+
+The script can also be run by a WSGI server (entry point: application),
+in which case loaded catalogues are kept in memory between requests.
 """
 
 import cgi
@@ -19,16 +25,35 @@ import json
 import sys, os
 import csv
 import math
-import numpy
-import healpy
+import threading
+from collections import OrderedDict
+from urllib.parse import parse_qs
+from xml.sax.saxutils import quoteattr
 
-cgitb.enable() # for debugging purposes, can be commented
+DEFAULT_CACHE_SIZE = 1000000 # max number of fields and indexed cells kept in memory
 
+VOTABLE = """<?xml version="1.0"?>
+<VOTABLE version="1.1" xmlns="http://www.ivoa.net/xml/VOTable/v1.1">{content}
+</VOTABLE>
+"""
 
-def output_error(votable, msg, exit=True):
+CONTENT_TYPE = 'text/xml;content=x-votable'
+
+
+class ConeSearchError(Exception):
+    """
+    Error reported to the client in the INFO element of the VOTable
+    """
+    pass
+
+
+def make_error(votable, msg):
     info="""
-    <INFO ID="Error" name="Error" value="{}" />""".format(msg)
-    print (votable.format(content=info))
+    <INFO ID="Error" name="Error" value={} />""".format(quoteattr(str(msg)))
+    return votable.format(content=info)
+
+def output_error(votable, msg, exit=True):
+    print (make_error(votable, msg))
     if exit:
         sys.exit()
     
@@ -53,6 +78,245 @@ def get_path(root, nside, ipix):
     return os.path.join(root, "nside{}/dir{}/npix{}.csv".format(
       nside, dir_idx, ipix))    
 
+def get_cell_index(root, nside):
+    """
+    Return the set of HEALPix cells (ipix) for which
+    a data file exists, for given root directory and nside
+
+    This lists the whole nside directory: only worth it
+    for a process serving several requests
+    """
+    cells = set()
+    nside_dir = os.path.join(root, "nside{}".format(nside))
+    if not os.path.isdir(nside_dir):
+        return cells
+
+    for dir_name in os.listdir(nside_dir):
+        dir_path = os.path.join(nside_dir, dir_name)
+        if not dir_name.startswith('dir') or not os.path.isdir(dir_path):
+            continue
+        for file_name in os.listdir(dir_path):
+            if file_name.startswith('npix') and file_name.endswith('.csv'):
+                try:
+                    cells.add(int(file_name[4:-4]))
+                except ValueError:
+                    pass
+
+    return cells
+
+def load_config(conf_path):
+    """
+    Read CGI config file and return a dict
+    mapping catalogue names to data paths,
+    the name of the default catalogue (or None)
+    and the cache size
+
+    Either the single catalogue form {"dataPath": ...}
+    or the multi-catalogue form
+    {"catalogues": {name: path, ...}, "defaultCatalogue": name}
+    is supported
+
+    Raise ConeSearchError if the config is missing or invalid
+    """
+    if not os.path.exists(conf_path):
+        raise ConeSearchError(
+          'Service error: could not find config file {}'.format(
+          conf_path))
+
+    with open(conf_path) as h:
+        config = json.loads(h.read())
+
+    if 'dataPath' in config and 'catalogues' in config:
+        raise ConeSearchError(
+          'Service error: config file {} defines both dataPath and catalogues'.format(
+          conf_path))
+
+    catalogues = OrderedDict()
+    default_name = config.get('defaultCatalogue')
+    if 'dataPath' in config:
+        data_path = os.path.abspath(config['dataPath'])
+        if default_name is None:
+            default_name = os.path.basename(data_path)
+        catalogues[default_name] = data_path
+    elif 'catalogues' in config:
+        for name, path in config['catalogues'].items():
+            catalogues[name] = os.path.abspath(path)
+        if default_name is None and len(catalogues)==1:
+            default_name = list(catalogues.keys())[0]
+    else:
+        raise ConeSearchError(
+          'Service error: config file {} defines neither dataPath nor catalogues'.format(
+          conf_path))
+
+    if default_name is not None and default_name not in catalogues:
+        raise ConeSearchError(
+          "Service error: default catalogue '{}' is not declared in config file {}".format(
+          default_name, conf_path))
+
+    cache_size = config.get('cacheSize', DEFAULT_CACHE_SIZE)
+
+    return catalogues, default_name, cache_size
+
+
+class Catalogue(object):
+    """
+    Handle on an ingested catalogue directory
+
+    metadata, FIELD elements and cell index are
+    loaded lazily, on first access.
+    If cell_index is False, existence of cell files
+    is checked on disk for each queried cell
+
+    Loading is done under a lock, as handles are shared
+    by the threads of a WSGI process
+    """
+
+    def __init__(self, name, data_path, cell_index=False):
+        self.name = name
+        self.data_path = data_path
+        self.metadata_path = get_metafile_path(data_path)
+        self.cell_index = cell_index
+        self.size = 0 # number of fields and indexed cells loaded
+        self._metadata = None
+        self._fields_as_votable = None
+        self._cells = None
+        self._radec_idx = None
+        self._lock = threading.RLock()
+
+    @property
+    def metadata(self):
+        if self._metadata is None:
+            with self._lock:
+                if self._metadata is None:
+                    with open(self.metadata_path) as h:
+                        metadata = json.loads(h.read())
+                    self.size += len(metadata['fields'])
+                    self._metadata = metadata
+        return self._metadata
+
+    @property
+    def fields(self):
+        return self.metadata['fields']
+
+    @property
+    def nside(self):
+        return self.metadata['nside']
+
+    @property
+    def fields_as_votable(self):
+        if self._fields_as_votable is None:
+            self._fields_as_votable = make_fields_as_votable(self.fields)
+        return self._fields_as_votable
+
+    @property
+    def cells(self):
+        if self._cells is None:
+            with self._lock:
+                if self._cells is None:
+                    cells = get_cell_index(self.data_path, self.nside)
+                    self.size += len(cells)
+                    self._cells = cells
+        return self._cells
+
+    @property
+    def radec_idx(self):
+        """
+        Indexes of fields with ucd POS_EQ_RA_MAIN and POS_EQ_DEC_MAIN
+        (None if not found)
+        """
+        if self._radec_idx is None:
+            ra_idx = None
+            dec_idx = None
+            for k, f in enumerate(self.fields):
+                if ra_idx is not None and dec_idx is not None:
+                    break
+                if 'ucd' in f:
+                    if f['ucd']=='POS_EQ_RA_MAIN':
+                        ra_idx = k
+                    elif f['ucd']=='POS_EQ_DEC_MAIN':
+                        dec_idx = k
+            self._radec_idx = (ra_idx, dec_idx)
+        return self._radec_idx
+
+    def get_cell_path(self, ipix):
+        return get_path(self.data_path, self.nside, ipix)
+
+    def has_cell(self, ipix):
+        if self.cell_index:
+            return ipix in self.cells
+        return os.path.exists(self.get_cell_path(ipix))
+
+
+class CatalogueRegistry(object):
+    """
+    Registry of catalogues served by this process
+
+    Catalogue handles are created on first use and kept
+    in least recently used order. When the number of fields
+    and indexed cells loaded by handles exceeds max_size,
+    least recently used handles are evicted (they will be
+    reloaded if needed)
+
+    get and evict can be called concurrently by several threads
+    """
+
+    def __init__(self, catalogues, default_name=None,
+                 max_size=DEFAULT_CACHE_SIZE, cell_index=False):
+        self.catalogues = catalogues
+        self.default_name = default_name
+        self.max_size = max_size
+        self.cell_index = cell_index
+        self._handles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, name=None):
+        """
+        Return handle for catalogue name (or default catalogue)
+
+        Raise KeyError if catalogue is unknown
+        """
+        if name is None:
+            name = self.default_name
+        if name not in self.catalogues:
+            raise KeyError(name)
+
+        with self._lock:
+            handle = self._handles.pop(name, None)
+            if handle is None:
+                handle = Catalogue(name, self.catalogues[name], self.cell_index)
+            self._handles[name] = handle
+
+        return handle
+
+    def evict(self):
+        """
+        Drop least recently used handles until loaded size
+        is below max_size (most recent handle is kept)
+        """
+        with self._lock:
+            total = sum(handle.size for handle in self._handles.values())
+            for name in list(self._handles.keys())[:-1]:
+                if total<=self.max_size:
+                    break
+                total -= self._handles.pop(name).size
+
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+def get_registry(conf_path, cell_index=False):
+    """
+    Return the catalogue registry for given config file,
+    created once per process
+    """
+    key = (conf_path, cell_index)
+    with _registries_lock:
+        if key not in _registries:
+            catalogues, default_name, cache_size = load_config(conf_path)
+            _registries[key] = CatalogueRegistry(catalogues, default_name,
+                                                 cache_size, cell_index)
+        return _registries[key]
+
 def make_fields_as_votable(fields):
     sb = ""
     for f in fields:
@@ -86,13 +350,16 @@ def sph_dist(ra1, dec1,ra2, dec2):
 
     return math.degrees(2*math.asin(math.sqrt(d)))
 
-def main():
-    votable="""Content-type: text/xml;content=x-votable\n
-<?xml version="1.0"?>
-<VOTABLE version="1.1" xmlns="http://www.ivoa.net/xml/VOTable/v1.1">{content}
-</VOTABLE>
-"""
+def query(params, registry):
+    """
+    Run a cone search query
 
+    params: dict mapping parameter names (RA, DEC, SR, CAT) to values
+    registry: CatalogueRegistry of served catalogues
+
+    Return the VOTable document as a string.
+    Raise ConeSearchError if the query can not be answered
+    """
     content="""
   <RESOURCE>
     <TABLE>{fields}
@@ -106,115 +373,94 @@ def main():
 
     tabledata=""
     
-    # check if config file is present
-    script_dir = os.path.abspath(os.path.dirname(sys.argv[0]))
-    conf_path = os.path.join(script_dir, get_cgi_config_file_name())
-    data_path = None
-    if not os.path.exists(conf_path):
-        # perhaps data is in the same directory
-        metadata_path = get_metafile_path('.')
-        if not os.path.exists(metadata_path):
-            output_error(votable, 
-            'Service error: could not find config file {}'.format(
-              conf_path))
-        else:
-            data_path = os.path.abspath('.')
-    else:
-        with open(conf_path) as h:
-            config = json.loads(h.read())
-        
-        data_path = os.path.abspath(config['dataPath'])
+    # select catalogue
+    cat_name = params.get('CAT')
+    if cat_name is None and registry.default_name is None:
+        raise ConeSearchError(
+          'Missing parameter CAT. Available catalogues: {}'.format(
+          ', '.join(registry.catalogues.keys())))
+    try:
+        catalogue = registry.get(cat_name)
+    except KeyError:
+        raise ConeSearchError(
+          "Unknown catalogue '{}'. Available catalogues: {}".format(
+          cat_name, ', '.join(registry.catalogues.keys())))
         
-    metadata_path = get_metafile_path(data_path)
+    metadata_path = catalogue.metadata_path
     if not os.path.exists(metadata_path):
-        output_error(votable, 
+        raise ConeSearchError(
           'Service error: could not find metadata file {}'.format(
           metadata_path))
         
-    with open(metadata_path) as h:
-        metadata = json.loads(h.read())
-            
     # retrieve info
-    fields = metadata['fields']
-    nside = metadata['nside']
-
-    # retrieve parameters
-    params = cgi.FieldStorage()
+    nside = catalogue.nside
+            
     # check presence of compulsory parameters
     for param_name in ('RA', 'DEC', 'SR'):
         if param_name not in params:
-            output_error(votable, 
+            raise ConeSearchError(
               "Missing compulsory parameter {}".format(param_name))
             
-    ra_str  = params.getfirst('RA')
-    dec_str = params.getfirst('DEC')
-    sr_str  = params.getfirst('SR')
+    ra_str  = params.get('RA')
+    dec_str = params.get('DEC')
+    sr_str  = params.get('SR')
 
     # Check if parameters are floating values
     try:
         ra = float(ra_str)
-    except:
-        output_error(votable, 
+    except ValueError:
+        raise ConeSearchError(
           "Could not parse value '{}' of RA parameter as a float".format(
           ra_str))
     try:
         dec = float(dec_str)
-    except:
-        output_error(votable, 
+    except ValueError:
+        raise ConeSearchError(
           "Could not parse value '{}' of DEC parameter as a float".format(
           dec_str))
     try:
         sr = float(sr_str)
-    except:
-        output_error(votable, 
+    except ValueError:
+        raise ConeSearchError(
           "Could not parse value '{}' of SR parameter as a float".format(
           sr_str))
 
     # Check if parameters are withing sensible range
     if ra<0 or ra>=360:
-        output_error(votable, 
+        raise ConeSearchError(
           'Value for RA parameter should be in range [0, 360[')
     if dec<-90 or dec>90:
-        output_error(votable, 
+        raise ConeSearchError(
           'Value for DEC parameter should be in range [-90, 90]')
     if sr<0:
-        output_error(votable, 
+        raise ConeSearchError(
           'Value for SR parameter should be >=0')
 
     # find RA and DEC indexes (needed to compute distance to center)
-    ra_idx = None
-    dec_idx = None
-    k = -1
-    for f in fields:
-        k += 1
-        if ra_idx and dec_idx:
-            break
-        if 'ucd' in f:
-            if f['ucd']=='POS_EQ_RA_MAIN':
-                ra_idx = k
-            elif f['ucd']=='POS_EQ_DEC_MAIN':
-                dec_idx = k
+    ra_idx, dec_idx = catalogue.radec_idx
         
     if ra_idx==None:
-        output_error(votable, 
+        raise ConeSearchError(
           """Could not find field with ucd='POS_EQ_RA_MAIN'. 
           Missing info in {}""".format(metadata_path))
 
     if dec_idx==None:
-        output_error(votable, 
+        raise ConeSearchError(
           """Could not find field with ucd='POS_EQ_DEC_MAIN'. 
           Missing info in {}""".format(metadata_path))
 
 
 
     # healpix query to retrieve data in requested cone
+    # (healpy is imported here, as it is slow to load)
+    import healpy
     theta, phi = radec2thetaphi(ra, dec) 
     vec = healpy.ang2vec(theta, phi)
     healpix_cells = healpy.query_disc(nside, vec, math.radians(sr), inclusive=True, nest=True)
     for ipix in healpix_cells:
-        ipix_path = get_path(data_path, nside, ipix)
-        if not os.path.exists(ipix_path):
+        if not catalogue.has_cell(ipix):
             continue
+        ipix_path = catalogue.get_cell_path(ipix)
         
         with open(ipix_path, 'r') as csvfile:
             reader = csv.reader(csvfile)
@@ -232,13 +478,82 @@ def main():
                 row_data="""</TD>
             <TD>""".join(row))
 
-    fields_as_votable=make_fields_as_votable(fields)
-
-    print (votable.format(
+    return VOTABLE.format(
       content=content.format(
-        fields=fields_as_votable, 
+        fields=catalogue.fields_as_votable,
         tabledata=tabledata)
-        ))
+        )
+
+def main():
+    """
+    CGI entry point
+    """
+    cgitb.enable() # for debugging purposes, can be commented
+
+    votable = "Content-type: {}\n\n".format(CONTENT_TYPE) + VOTABLE
+
+    # check if config file is present
+    script_dir = os.path.abspath(os.path.dirname(sys.argv[0]))
+    conf_path = os.path.join(script_dir, get_cgi_config_file_name())
+    if not os.path.exists(conf_path):
+        # perhaps data is in the same directory
+        metadata_path = get_metafile_path('.')
+        if not os.path.exists(metadata_path):
+            output_error(votable,
+            'Service error: could not find config file {}'.format(
+              conf_path))
+        data_path = os.path.abspath('.')
+        name = os.path.basename(data_path)
+        registry = CatalogueRegistry({name: data_path}, name)
+    else:
+        try:
+            registry = get_registry(conf_path)
+        except ConeSearchError as e:
+            output_error(votable, e)
+
+    # retrieve parameters
+    form = cgi.FieldStorage()
+    params = dict((k, form.getfirst(k)) for k in form.keys())
+
+    try:
+        response = query(params, registry)
+    except ConeSearchError as e:
+        output_error(votable, e)
+
+    print ("Content-type: {}\n\n".format(CONTENT_TYPE) + response)
+
+def application(environ, start_response):
+    """
+    WSGI entry point
+
+    The config file is given by the SCSC_CONFIG environment variable
+    (default: cgi-config.json next to this script), which can be set
+    per request (e.g. per virtual host).
+    The catalogue registry of each config file, along with the cell index
+    of each catalogue, is kept between requests
+    """
+    conf_path = environ.get('SCSC_CONFIG', os.environ.get('SCSC_CONFIG',
+      os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                   get_cgi_config_file_name())))
+    params = dict((k, v[0]) for k, v in
+                  parse_qs(environ.get('QUERY_STRING', '')).items())
+
+    registry = None
+    try:
+        registry = get_registry(conf_path, cell_index=True)
+        response = query(params, registry)
+    except ConeSearchError as e:
+        response = make_error(VOTABLE, e)
+    except Exception as e:
+        response = make_error(VOTABLE, 'Service error: {}'.format(e))
+    finally:
+        if registry is not None:
+            registry.evict()
+
+    body = response.encode('utf-8')
+    start_response('200 OK', [('Content-Type', CONTENT_TYPE),
+                              ('Content-Length', str(len(body)))])
+    return [body]
 
         
 #print '<!-- ' + str(healpix_cells) + '-->'
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the catalogue registry of the CGI script cs.py
+"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import types
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cgi'))
+
+import cs
+
+
+FIELDS = [
+    {'name': 'ra', 'ucd': 'POS_EQ_RA_MAIN', 'datatype': 'double'},
+    {'name': 'dec', 'ucd': 'POS_EQ_DEC_MAIN', 'datatype': 'double'},
+    {'name': 'id', 'datatype': 'char'},
+]
+
+
+class CatalogueTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def make_catalogue(self, name, cells=(), nside=32, rows=None):
+        """
+        Create a catalogue directory with empty cell files,
+        or with given rows (dict mapping ipix to list of rows)
+        """
+        data_path = os.path.join(self.root, name)
+        os.makedirs(data_path)
+        with open(cs.get_metafile_path(data_path), 'w') as h:
+            h.write(json.dumps({'nside': nside, 'fields': FIELDS}))
+        rows = rows or {}
+        for ipix in set(cells) | set(rows.keys()):
+            cell_path = cs.get_path(data_path, nside, ipix)
+            if not os.path.isdir(os.path.dirname(cell_path)):
+                os.makedirs(os.path.dirname(cell_path))
+            with open(cell_path, 'w') as h:
+                for row in rows.get(ipix, []):
+                    h.write(','.join(row) + '\n')
+        return data_path
+
+    def make_config(self, config):
+        conf_path = os.path.join(self.root, cs.get_cgi_config_file_name())
+        with open(conf_path, 'w') as h:
+            h.write(json.dumps(config))
+        return conf_path
+
+
+class TestGetCellIndex(CatalogueTestCase):
+
+    def test_cells(self):
+        data_path = self.make_catalogue('A', cells=(12, 10012, 42))
+        self.assertEqual(cs.get_cell_index(data_path, 32), set([12, 42, 10012]))
+
+    def test_missing_nside_dir(self):
+        data_path = self.make_catalogue('A')
+        self.assertEqual(cs.get_cell_index(data_path, 32), set())
+
+    def test_stray_entries_are_ignored(self):
+        data_path = self.make_catalogue('A', cells=(12,))
+        nside_dir = os.path.join(data_path, 'nside32')
+        open(os.path.join(nside_dir, 'stray.txt'), 'w').close()
+        open(os.path.join(nside_dir, 'dir_file'), 'w').close()
+        os.makedirs(os.path.join(nside_dir, 'other'))
+        open(os.path.join(nside_dir, 'other', 'npix7.csv'), 'w').close()
+        self.assertEqual(cs.get_cell_index(data_path, 32), set([12]))
+
+
+class TestLoadConfig(CatalogueTestCase):
+
+    def test_data_path(self):
+        data_path = self.make_catalogue('A')
+        conf_path = self.make_config({'dataPath': data_path})
+        catalogues, default_name, cache_size = cs.load_config(conf_path)
+        self.assertEqual(dict(catalogues), {'A': data_path})
+        self.assertEqual(default_name, 'A')
+        self.assertEqual(cache_size, cs.DEFAULT_CACHE_SIZE)
+
+    def test_catalogues(self):
+        conf_path = self.make_config({
+            'catalogues': {'A': os.path.join(self.root, 'A'),
+                           'B': os.path.join(self.root, 'B')},
+            'defaultCatalogue': 'B',
+            'cacheSize': 10})
+        catalogues, default_name, cache_size = cs.load_config(conf_path)
+        self.assertEqual(sorted(catalogues.keys()), ['A', 'B'])
+        self.assertEqual(default_name, 'B')
+        self.assertEqual(cache_size, 10)
+
+    def test_single_catalogue_is_default(self):
+        conf_path = self.make_config({
+            'catalogues': {'A': os.path.join(self.root, 'A')}})
+        self.assertEqual(cs.load_config(conf_path)[1], 'A')
+
+    def test_no_default(self):
+        conf_path = self.make_config({
+            'catalogues': {'A': os.path.join(self.root, 'A'),
+                           'B': os.path.join(self.root, 'B')}})
+        self.assertIsNone(cs.load_config(conf_path)[1])
+
+    def test_invalid_configs(self):
+        for config in ({'dataPath': self.root, 'catalogues': {'A': self.root}},
+                       {'catalogues': {'A': self.root}, 'defaultCatalogue': 'B'},
+                       {}):
+            conf_path = self.make_config(config)
+            self.assertRaises(cs.ConeSearchError, cs.load_config, conf_path)
+
+    def test_missing_config(self):
+        self.assertRaises(cs.ConeSearchError, cs.load_config,
+                          os.path.join(self.root, 'missing.json'))
+
+
+class TestCatalogueRegistry(CatalogueTestCase):
+
+    def make_registry(self, names, max_size=cs.DEFAULT_CACHE_SIZE, cell_index=False):
+        catalogues = dict((name, self.make_catalogue(name, cells=(12, 42)))
+                          for name in names)
+        return cs.CatalogueRegistry(catalogues, names[0], max_size, cell_index)
+
+    def test_get(self):
+        registry = self.make_registry(['A', 'B'])
+        self.assertEqual(registry.get().name, 'A')
+        self.assertIs(registry.get('B'), registry.get('B'))
+        self.assertRaises(KeyError, registry.get, 'C')
+
+    def test_lazy_loading(self):
+        registry = self.make_registry(['A'], cell_index=True)
+        catalogue = registry.get('A')
+        self.assertEqual(catalogue.size, 0)
+        self.assertEqual(catalogue.radec_idx, (0, 1))
+        self.assertEqual(catalogue.size, len(FIELDS))
+        self.assertTrue(catalogue.has_cell(12))
+        self.assertFalse(catalogue.has_cell(13))
+        self.assertEqual(catalogue.size, len(FIELDS)+2)
+
+    def test_has_cell_without_index(self):
+        registry = self.make_registry(['A'])
+        catalogue = registry.get('A')
+        self.assertTrue(catalogue.has_cell(42))
+        self.assertFalse(catalogue.has_cell(13))
+        self.assertIsNone(catalogue._cells)
+
+    def test_evict_least_recently_used(self):
+        registry = self.make_registry(['A', 'B', 'C'], max_size=2*len(FIELDS))
+        for name in ('A', 'B', 'C', 'A'):
+            registry.get(name).fields
+        registry.evict()
+        self.assertEqual(list(registry._handles.keys()), ['C', 'A'])
+
+    def test_concurrent_access(self):
+        registry = self.make_registry(['A', 'B'], max_size=0, cell_index=True)
+        errors = []
+
+        def worker():
+            try:
+                for k in range(2000):
+                    registry.get('A').cells
+                    registry.get('B').fields
+                    registry.evict()
+            except Exception as e:
+                errors.append(e)
+
+        # switch threads as often as possible to expose races
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            threads = [threading.Thread(target=worker) for k in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            sys.setswitchinterval(interval)
+        self.assertEqual(errors, [])
+        for handle in registry._handles.values():
+            self.assertIn(handle.size, (len(FIELDS), len(FIELDS)+2))
+
+    def test_evict_keeps_most_recent(self):
+        registry = self.make_registry(['A', 'B'], max_size=0)
+        registry.get('A').fields
+        registry.get('B').fields
+        registry.evict()
+        self.assertEqual(list(registry._handles.keys()), ['B'])
+
+
+class FakeHealpy(types.ModuleType):
+    """
+    Stand-in for healpy: query_disc returns a fixed list of cells
+    """
+
+    def __init__(self, cells):
+        types.ModuleType.__init__(self, 'healpy')
+        self.cells = cells
+
+    def ang2vec(self, theta, phi):
+        return theta, phi
+
+    def query_disc(self, nside, vec, radius, inclusive=False, nest=False):
+        return self.cells
+
+
+class TestApplication(CatalogueTestCase):
+
+    def setUp(self):
+        CatalogueTestCase.setUp(self)
+        self.healpy = sys.modules.get('healpy')
+        sys.modules['healpy'] = FakeHealpy([12, 42, 13])
+        self.make_catalogue('A', rows={
+            12: [('10.0', '10.0', 'a1'), ('10.5', '10.0', 'a2')],
+            42: [('20.0', '10.0', 'a3')]})
+        self.make_catalogue('B', rows={
+            42: [('10.2', '10.1', 'b1')]})
+        self.conf_path = self.make_config({
+            'catalogues': {'A': os.path.join(self.root, 'A'),
+                           'B': os.path.join(self.root, 'B')},
+            'defaultCatalogue': 'A',
+            'cacheSize': 0})
+
+    def tearDown(self):
+        if self.healpy is None:
+            del sys.modules['healpy']
+        else:
+            sys.modules['healpy'] = self.healpy
+        cs._registries.pop((self.conf_path, True), None)
+        CatalogueTestCase.tearDown(self)
+
+    def call(self, query_string, conf_path=None):
+        status = []
+        environ = {'QUERY_STRING': query_string,
+                   'SCSC_CONFIG': conf_path or self.conf_path}
+        body = cs.application(environ, lambda s, h: status.append(s))
+        self.assertEqual(status, ['200 OK'])
+        return b''.join(body).decode('utf-8')
+
+    def get_registry(self):
+        return cs._registries[(self.conf_path, True)]
+
+    def test_query_catalogues(self):
+        response = self.call('RA=10&DEC=10&SR=1')
+        self.assertIn('<TD>a1</TD>', response)
+        self.assertIn('<TD>a2</TD>', response)
+        self.assertNotIn('a3', response)
+        self.assertNotIn('b1', response)
+        self.assertEqual(list(self.get_registry()._handles.keys()), ['A'])
+
+        response = self.call('CAT=B&RA=10&DEC=10&SR=1')
+        self.assertIn('<TD>b1</TD>', response)
+        self.assertNotIn('a1', response)
+        # cacheSize is 0: only the most recent catalogue is kept
+        self.assertEqual(list(self.get_registry()._handles.keys()), ['B'])
+        self.assertEqual(self.get_registry().get('B').cells, set([42]))
+
+    def test_evict_after_error(self):
+        self.call('CAT=A&RA=10&DEC=10&SR=1')
+        response = self.call('CAT=B&RA=foo&DEC=10&SR=1')
+        self.assertIn('Could not parse value', response)
+        self.assertEqual(list(self.get_registry()._handles.keys()), ['B'])
+
+    def test_unexpected_error(self):
+        with open(cs.get_metafile_path(os.path.join(self.root, 'B')), 'w') as h:
+            h.write(json.dumps({'fields': FIELDS}))
+        response = self.call('CAT=B&RA=10&DEC=10&SR=1')
+        self.assertIn('value="Service error:', response)
+
+    def test_registry_per_config(self):
+        conf_path = os.path.join(self.root, 'other.json')
+        with open(conf_path, 'w') as h:
+            h.write(json.dumps({'dataPath': os.path.join(self.root, 'B')}))
+        self.call('RA=10&DEC=10&SR=1')
+        self.assertIn('<TD>b1</TD>', self.call('RA=10&DEC=10&SR=1', conf_path))
+        registry = self.get_registry()
+        self.call('RA=10&DEC=10&SR=1')
+        self.assertIs(self.get_registry(), registry)
+        cs._registries.pop((conf_path, True))
+
+
+class TestErrors(unittest.TestCase):
+
+    def test_error_is_escaped(self):
+        error = cs.make_error(cs.VOTABLE, 'Unknown catalogue \'<x>"&\'')
+        self.assertIn('value="Unknown catalogue \'&lt;x&gt;&quot;&amp;\'"', error)
+
+    def test_unknown_catalogue(self):
+        registry = cs.CatalogueRegistry({'A': '/nonexistent'}, 'A')
+        self.assertRaises(cs.ConeSearchError, cs.query,
+                          {'CAT': 'B', 'RA': '0', 'DEC': '0', 'SR': '0'}, registry)
+
+
+if __name__ == '__main__':
+    unittest.main()